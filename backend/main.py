@@ -1,12 +1,25 @@
 import os
 import json
-import traceback
+import logging
+import asyncio
+import tempfile
 import re
-from typing import Dict, Any, Optional, List
+import secrets
+import string
+import time
+import sys
+import unicodedata
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from logging.handlers import RotatingFileHandler
+from typing import Dict, Any, Optional, List, Set, Tuple
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile, File, Body
+from fastapi import FastAPI, UploadFile, File, Body, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 
 from google import genai
 
@@ -14,6 +27,18 @@ from google import genai
 import pyttsx3  # noqa: F401
 from fastapi import HTTPException
 
+# (Optional) faster parsing of Gemini's JSON replies; stdlib json is used when missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# (Optional) single-pass multi-pattern text scanner; precompiled re is used when missing
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
 
 # ------------------ ENV + CLIENT ------------------
 
@@ -25,18 +50,103 @@ if not GEMINI_API_KEY:
 
 gemini = genai.Client(api_key=GEMINI_API_KEY)
 GEMINI_MODEL = "models/gemini-2.5-flash"
+# Gemini caps an inline-data request at 20 MB *after* base64 (4/3 growth);
+# keep 64 KB of that for prompt/JSON overhead when sizing raw audio.
+GEMINI_INLINE_REQUEST_BYTES = 20 * 1000 * 1000
+GEMINI_INLINE_AUDIO_BYTES = GEMINI_INLINE_REQUEST_BYTES * 3 // 4 - 64 * 1024
+MAX_UPLOAD_BYTES = GEMINI_INLINE_AUDIO_BYTES  # largest clip that still fits one inline Gemini request
+MAX_UPLOAD_BODY_BYTES = MAX_UPLOAD_BYTES + 64 * 1024  # plus multipart framing
+
+
+# ------------------ LOGGING ------------------
+# Raw transcripts/intents are DEBUG, bookings + MCP payloads INFO, fallbacks WARNING.
+# Lazy %-args mean nothing is formatted for levels that are switched off.
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "WARNING").upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):  # typo'd level: don't crash at import
+    LOG_LEVEL = "WARNING"
+LOG_FILE = os.environ.get("LOG_FILE", "advisor.log")
+
+logger = logging.getLogger("advisor")
+logger.setLevel(LOG_LEVEL)
+
+
+def configure_logging():
+    """Log to the uvicorn console (as the old prints did) and to a rotating file."""
+    if logger.handlers:
+        return
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    for handler in (
+        logging.StreamHandler(),
+        RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8"),
+    ):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
 
 
 # ------------------ APP ------------------
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_logging()
+    if SAVE_UPLOADS:
+        os.makedirs(TMP_DIR, exist_ok=True)
+    start_transcribe_batchers()
+    try:
+        yield
+    finally:
+        await stop_transcribe_batchers()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class UploadLimitMiddleware:
+    """Cap the request body of one route before FastAPI spools it for File(...) params.
+
+    Rejects on Content-Length up front and counts streamed bytes for chunked uploads.
+    """
+
+    def __init__(self, app, path: str, max_bytes: int):
+        self.app = app
+        self.path = path
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            await JSONResponse({"detail": "audio too large"}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Raised inside the route's body parsing, which re-raises HTTPException
+                    # for FastAPI's own exception handling to answer 413
+                    raise HTTPException(status_code=413, detail="audio too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
 
+
+# Added first so it sits inside CORSMiddleware and its 413s still carry CORS headers
+app.add_middleware(UploadLimitMiddleware, path="/api/voice-turn", max_bytes=MAX_UPLOAD_BODY_BYTES)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Session-Id"],
 )
 
 
@@ -44,6 +154,9 @@ app.add_middleware(
 
 TIMEZONE_LABEL = "IST"
 SECURE_LINK_BASE = "http://localhost:5173/secure"  # Option B secure page route
+TMP_DIR = "tmp"
+UPLOAD_CHUNK_SIZE = 1 << 20  # read uploads 1 MiB at a time
+SAVE_UPLOADS = os.environ.get("SAVE_VOICE_UPLOADS") == "1"  # debug: keep uploads in TMP_DIR
 
 TOPICS = [
     "KYC/Onboarding",
@@ -53,6 +166,15 @@ TOPICS = [
     "Account Changes/Nominee",
 ]
 
+INTENTS = [
+    "book_new",
+    "reschedule",
+    "cancel",
+    "what_to_prepare",
+    "check_availability",
+    "other",
+]
+
 MOCK_SLOTS = [
     {"slot_id": "SLOT-101", "start": "2026-01-02 10:00 AM", "end": "10:30 AM"},
     {"slot_id": "SLOT-102", "start": "2026-01-02 11:00 AM", "end": "11:30 AM"},
@@ -61,41 +183,103 @@ MOCK_SLOTS = [
 ]
 
 
-# ------------------ STATE ------------------
+# ------------------ SESSIONS ------------------
 
-STATE: Dict[str, Any] = {
-    "disclaimer_done": False,
-    "intent": None,
+SESSION_TTL_S = 30 * 60  # idle sessions are evicted after this
+SESSION_ID_MAX_LEN = 64
+
+
+@dataclass(slots=True)
+class SessionState:
+    disclaimer_done: bool = False
+    intent: Optional[str] = None
 
     # booking flow
-    "topic": None,
-    "day_pref": None,
-    "time_pref": None,
-    "offered_slots": None,
-    "selected_slot": None,
-    "booking_code": None,
+    topic: Optional[str] = None
+    day_pref: Optional[str] = None
+    time_pref: Optional[str] = None
+    offered_slots: Optional[List[Dict[str, str]]] = None
+    selected_slot: Optional[Dict[str, str]] = None
+    booking_code: Optional[str] = None
 
     # reschedule/cancel
-    "provided_code": None,
-}
+    provided_code: Optional[str] = None
+
+    # serializes turns within one session; sessions never block each other
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+    last_seen: float = field(default_factory=time.monotonic, repr=False)
+
+
+# Kept in last-seen order (oldest first), so idle sessions are always at the front
+SESSIONS: "OrderedDict[str, SessionState]" = OrderedDict()
+
+
+def get_session(session_id: Optional[str]) -> Tuple[str, SessionState]:
+    """
+    Look up the caller's session, creating one (with a fresh id if none was sent).
+    Idle sessions are evicted from the front of SESSIONS; each lookup is amortized O(1).
+    """
+    now = time.monotonic()
+    session_id = (session_id or "")[:SESSION_ID_MAX_LEN] or uuid.uuid4().hex
+
+    state = SESSIONS.get(session_id)
+    if state is None:
+        state = SESSIONS[session_id] = SessionState()
+    else:
+        SESSIONS.move_to_end(session_id)
+    state.last_seen = now
+
+    while SESSIONS:
+        oldest = next(iter(SESSIONS.values()))
+        if now - oldest.last_seen <= SESSION_TTL_S:
+            break
+        SESSIONS.popitem(last=False)
+
+    return session_id, state
+
 
 # ------------------ SECURE DETAILS STORE (Option B) ------------------
 # Demo-only in-memory store; replace with DB in production
-SECURE_DETAILS_STORE: Dict[str, Any] = {}
-BOOKINGS: Dict[str, Any] = {}
 
+class ShardedStore:
+    """
+    Dict split into independent shards, each guarded by its own asyncio.Lock,
+    so writers for different keys don't contend. Plain reads skip the lock.
+    """
+    __slots__ = ("shards", "locks")
+
+    def __init__(self, n: int = 16):
+        assert n & (n - 1) == 0, "shard count must be a power of two"
+        self.shards: List[Dict[str, Any]] = [{} for _ in range(n)]
+        self.locks = [asyncio.Lock() for _ in range(n)]
 
-def reset_booking_state():
-    STATE["topic"] = None
-    STATE["day_pref"] = None
-    STATE["time_pref"] = None
-    STATE["offered_slots"] = None
-    STATE["selected_slot"] = None
-    STATE["booking_code"] = None
+    def _s(self, key: str) -> int:
+        return hash(key) & (len(self.shards) - 1)
 
+    async def set(self, key: str, value: Any) -> None:
+        i = self._s(key)
+        async with self.locks[i]:
+            self.shards[i][key] = value
 
-def reset_reschedule_cancel():
-    STATE["provided_code"] = None
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.shards[self._s(key)].get(key, default)
+
+
+SECURE_DETAILS_STORE = ShardedStore()
+BOOKINGS = ShardedStore()
+
+
+def reset_booking_state(state: SessionState):
+    state.topic = None
+    state.day_pref = None
+    state.time_pref = None
+    state.offered_slots = None
+    state.selected_slot = None
+    state.booking_code = None
+
+
+def reset_reschedule_cancel(state: SessionState):
+    state.provided_code = None
 
 
 # ------------------ PII GUARD ------------------
@@ -108,76 +292,215 @@ PII_PATTERNS = [
     r"\baccount\b.*\b\d+\b",                       # "account 123..."
 ]
 
+# One alternation so each turn is scanned once instead of once per pattern.
+# ASCII \b/\d so these match exactly like the Hyperscan build (see TEXT SCANNER);
+# scan_text folds other scripts' digits to ASCII first so "९८७६५४३२१०" still counts.
+PII_RE = re.compile("|".join(f"(?:{p})" for p in PII_PATTERNS), re.IGNORECASE | re.ASCII)
+BOOKING_CODE_RE = re.compile(r"\bNL-[A-Z0-9]{4}\b", re.IGNORECASE | re.ASCII)
+
+# Investment-advice guard; plain substrings so "investment"/"stocks" also trip it
+ADVICE_WORDS = ("buy", "sell", "invest", "stock", "mutual fund", "recommend")
+ADVICE_RE = re.compile("|".join(map(re.escape, ADVICE_WORDS)), re.IGNORECASE | re.ASCII)
+
+
+# Decimal digits (category Nd) only, i.e. what a Unicode \d matched; "²"/"①" stay as is.
+# One char -> one char, so match offsets into the folded text stay valid.
+ASCII_DIGITS = {
+    cp: str(d)
+    for cp in range(128, sys.maxunicode + 1)
+    if (d := unicodedata.decimal(chr(cp), None)) is not None
+}
+
+
+def fold_digits(text: str) -> str:
+    return text if text.isascii() else text.translate(ASCII_DIGITS)
+
 
 def contains_pii(text: str) -> bool:
-    for p in PII_PATTERNS:
-        if re.search(p, text, flags=re.IGNORECASE):
-            return True
-    return False
+    """Expects fold_digits() text, as scan_text passes."""
+    return PII_RE.search(text) is not None
 
 
 def extract_booking_code(text: str) -> Optional[str]:
-    m = re.search(r"\bNL-[A-Z0-9]{4}\b", text.upper())
-    return m.group(0) if m else None
+    # Case-insensitive match, so only the 7-char code is upper-cased, not the transcript
+    m = BOOKING_CODE_RE.search(text)
+    return m.group(0).upper() if m else None
 
 
 # ------------------ HELPERS ------------------
 
+BOOKING_CODE_ALPHABET = string.ascii_uppercase + string.digits
+BOOKING_CODE_LEN = 4
+
+
 def generate_booking_code() -> str:
-    import random, string
-    return "NL-" + "".join(random.choice(string.ascii_uppercase + string.digits) for _ in range(4))
+    # One CSPRNG draw over the whole code space, spelled out in base 36
+    n = secrets.randbelow(len(BOOKING_CODE_ALPHABET) ** BOOKING_CODE_LEN)
+    chars = []
+    for _ in range(BOOKING_CODE_LEN):
+        n, i = divmod(n, len(BOOKING_CODE_ALPHABET))
+        chars.append(BOOKING_CODE_ALPHABET[i])
+    return "NL-" + "".join(chars)
 
 
 def secure_link_for(code: str) -> str:
     return f"{SECURE_LINK_BASE}?code={code}"
 
 
-def transcribe(audio_path: str) -> str:
+def json_loads(text: str) -> Any:
+    return orjson.loads(text) if orjson else json.loads(text)
+
+
+TRANSCRIBE_PROMPT = (
+    "Transcribe the audio into plain text only. "
+    "Output ONLY the transcript. No commentary, no labels."
+)
+TRANSCRIBE_BATCH_PROMPT = (
+    "Transcribe each audio clip into plain text only. "
+    "Output ONLY a JSON array of strings: one transcript per clip, in the order given. "
+    "No commentary, no labels."
+)
+TRANSCRIBE_BATCH_SCHEMA = {"type": "ARRAY", "items": {"type": "STRING"}}
+
+
+def _audio_part(clip: Tuple[bytes, str]) -> Dict[str, Any]:
+    audio_bytes, mime_type = clip
+    return {"inline_data": {"mime_type": mime_type, "data": audio_bytes}}
+
+
+async def transcribe_many(clips: List[Tuple[bytes, str]]) -> List[str]:
     """
-    Gemini multimodal transcription.
-    If Gemini quota is exceeded, return empty string rather than crashing.
+    Gemini multimodal transcription of one or more (audio_bytes, mime_type)
+    clips in a single request.
+    If Gemini quota is exceeded, return empty strings rather than crashing.
     """
     try:
-        with open(audio_path, "rb") as f:
-            audio_bytes = f.read()
+        if len(clips) == 1:
+            resp = await gemini.aio.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=[{"role": "user", "parts": [{"text": TRANSCRIBE_PROMPT}, _audio_part(clips[0])]}],
+            )
+            text = (resp.text or "").strip()
+            logger.debug("TRANSCRIPTION RAW: %r", text)
+            return [text]
 
-        resp = gemini.models.generate_content(
+        resp = await gemini.aio.models.generate_content(
             model=GEMINI_MODEL,
             contents=[
                 {
                     "role": "user",
-                    "parts": [
-                        {
-                            "text": (
-                                "Transcribe the audio into plain text only. "
-                                "Output ONLY the transcript. No commentary, no labels."
-                            )
-                        },
-                        {
-                            "inline_data": {
-                                "mime_type": "audio/webm",
-                                "data": audio_bytes,
-                            }
-                        },
-                    ],
+                    "parts": [{"text": TRANSCRIBE_BATCH_PROMPT}] + [_audio_part(c) for c in clips],
                 }
             ],
+            config={"response_mime_type": "application/json", "response_schema": TRANSCRIBE_BATCH_SCHEMA},
         )
+        raw = (resp.text or "").strip()
+        logger.debug("TRANSCRIPTION BATCH RAW: %r", raw)
 
-        text = (resp.text or "").strip()
-        print("TRANSCRIPTION RAW:", repr(text))
-        return text
+        texts = json_loads(raw)
+        if not isinstance(texts, list) or len(texts) != len(clips):
+            raise ValueError(f"expected {len(clips)} transcripts, got {raw!r}")
+        return [str(t or "").strip() for t in texts]
 
     except Exception as e:
-        print("TRANSCRIBE_FALLBACK_REASON:", repr(e))
+        logger.warning("TRANSCRIBE_FALLBACK_REASON: %r", e)
+        if len(clips) > 1:
+            # Batch response unusable: retry clip by clip, concurrently
+            results = await asyncio.gather(*(transcribe_many([clip]) for clip in clips))
+            return [texts[0] for texts in results]
         # Best-effort fallback: return empty string so agent asks to repeat
-        return ""
+        return [""]
+
+
+# ------------------ TRANSCRIPTION BATCHING ------------------
+# Concurrent voice turns are pooled into one Gemini request: the first clip
+# opens a short window, and the batch closes when it fills (by clip count or
+# total bytes) or the window ends.
+
+TRANSCRIBE_BATCH_MAX = 8
+TRANSCRIBE_BATCH_MAX_BYTES = GEMINI_INLINE_AUDIO_BYTES
+TRANSCRIBE_BATCH_WINDOW_S = 0.05
+# Bucket by upload size (a proxy for duration; webm/opus speech is ~16 KB/s)
+# so short clips don't wait on long ones in the same request.
+TRANSCRIBE_BUCKET_BYTES = [160 * 1024]  # < ~10 s, then everything longer
+
+TRANSCRIBE_QUEUES: List[asyncio.Queue] = []
+_BACKGROUND_TASKS: List[asyncio.Task] = []
+
+
+async def _run_transcribe_batch(batch: List[Tuple[Tuple[bytes, str], asyncio.Future]]) -> None:
+    try:
+        texts = await transcribe_many([clip for clip, _ in batch])
+    except Exception as e:
+        logger.exception("TRANSCRIBE_BATCH_ERROR: %r", e)
+        texts = [""] * len(batch)
+    for (_, fut), text in zip(batch, texts):
+        if not fut.done():
+            fut.set_result(text)
+
+
+async def _transcribe_batcher(queue: asyncio.Queue) -> None:
+    loop = asyncio.get_running_loop()
+    carry = None  # clip that didn't fit the previous batch; it opens the next one
+    while True:
+        first = carry if carry is not None else await queue.get()
+        carry = None
+        batch = [first]
+        batch_bytes = len(first[0][0])
+        deadline = loop.time() + TRANSCRIBE_BATCH_WINDOW_S
+        while len(batch) < TRANSCRIBE_BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if batch_bytes + len(item[0][0]) > TRANSCRIBE_BATCH_MAX_BYTES:
+                # Would push the request past Gemini's inline limit: send what we have
+                carry = item
+                break
+            batch.append(item)
+            batch_bytes += len(item[0][0])
+        # Dispatch and go straight back to collecting the next batch
+        _BACKGROUND_TASKS.append(asyncio.create_task(_run_transcribe_batch(batch)))
+        _BACKGROUND_TASKS[:] = [t for t in _BACKGROUND_TASKS if not t.done()]
+
+
+def start_transcribe_batchers() -> None:
+    # Fresh queues per lifespan: a queue whose batcher ran on an earlier event loop
+    # would never be drained
+    TRANSCRIBE_QUEUES.clear()
+    for _ in range(len(TRANSCRIBE_BUCKET_BYTES) + 1):
+        queue: asyncio.Queue = asyncio.Queue()
+        TRANSCRIBE_QUEUES.append(queue)
+        _BACKGROUND_TASKS.append(asyncio.create_task(_transcribe_batcher(queue)))
+
+
+async def stop_transcribe_batchers() -> None:
+    """Cancel the batchers and any batch still in flight."""
+    tasks = _BACKGROUND_TASKS[:]
+    _BACKGROUND_TASKS.clear()
+    TRANSCRIBE_QUEUES.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def transcribe_batched(audio_bytes: bytes, mime_type: str = "audio/webm") -> str:
+    bucket = sum(len(audio_bytes) >= limit for limit in TRANSCRIBE_BUCKET_BYTES)
+    fut = asyncio.get_running_loop().create_future()
+    await TRANSCRIBE_QUEUES[bucket].put(((audio_bytes, mime_type), fut))
+    return await fut
 
 
 
 def _json_fallback() -> Dict[str, Any]:
     return {"intent": "other", "topic": None, "day_preference": None, "time_preference": None}
 
+_JSON_DECODER = json.JSONDecoder()
+
+
 def extract_first_json_object(text: str) -> Optional[dict]:
     """
     Pull the first {...} JSON object from text (handles ```json fences and extra words).
@@ -185,72 +508,211 @@ def extract_first_json_object(text: str) -> Optional[dict]:
     """
     if not text:
         return None
-    m = re.search(r"\{[\s\S]*\}", text)
-    if not m:
+    # JSON-mode responses are usually exactly one object: parse it whole first
+    try:
+        obj = json_loads(text)
+        if isinstance(obj, dict):
+            return obj
+    except ValueError:
+        pass
+
+    start = text.find("{")
+    if start < 0:
         return None
     try:
-        return json.loads(m.group(0))
-    except Exception:
+        # Stops at the end of the first complete object; trailing fences/prose are ignored
+        obj, _ = _JSON_DECODER.raw_decode(text, start)
+    except ValueError:
         return None
+    return obj if isinstance(obj, dict) else None
+
+
+# (field, value, keywords) in precedence order: earlier rows win within a field
+LOCAL_KEYWORDS = [
+    ("topic", "KYC/Onboarding", ("kyc", "onboard")),
+    ("topic", "SIP/Mandates", ("sip", "mandate")),
+    ("topic", "Statements/Tax Docs", ("statement", "tax")),
+    ("topic", "Withdrawals & Timelines", ("withdraw", "timeline", "redemption")),
+    ("topic", "Account Changes/Nominee", ("nominee", "account change", "profile")),
+    ("day_preference", "tomorrow", ("tomorrow",)),
+    ("day_preference", "today", ("today",)),
+    *[("day_preference", d, (d,)) for d in
+      ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]],
+    ("time_preference", "morning", ("morning",)),
+    ("time_preference", "afternoon", ("afternoon",)),
+    ("time_preference", "evening", ("evening", "night")),
+    ("intent", "reschedule", ("reschedule", "move my", "change my time", "change slot")),
+    ("intent", "cancel", ("cancel", "call off", "delete booking")),
+    ("intent", "what_to_prepare", ("prepare", "what should i bring", "what to prepare")),
+    ("intent", "check_availability", ("availability", "available", "check availability", "any slots")),
+    ("intent", "book_new", ("book", "appointment", "schedule")),
+]
 
+LOCAL_KEYWORDS_BY_RANK: List[Tuple[str, str, int]] = [
+    (field, value, rank) for rank, (field, value, _) in enumerate(LOCAL_KEYWORDS)
+]
+
+# One named group per row; m.lastgroup indexes straight into this table
+LOCAL_KEYWORD_GROUPS: Dict[str, Tuple[str, str, int]] = {
+    f"r{rank}": row for rank, row in enumerate(LOCAL_KEYWORDS_BY_RANK)
+}
+
+# Zero-width lookahead so overlapping keywords ("account change my time") are all reported.
+# No keyword is a prefix of another, so every occurrence of every keyword is reported.
+LOCAL_KEYWORD_RE = re.compile(
+    "(?=(?:"
+    + "|".join(
+        f"(?P<r{rank}>" + "|".join(re.escape(kw) for kw in sorted(kws, key=len, reverse=True)) + ")"
+        for rank, (_, _, kws) in enumerate(LOCAL_KEYWORDS)
+    )
+    + "))",
+    re.IGNORECASE | re.ASCII,  # ASCII case folding, like the Hyperscan literals
+)
 
-def local_intent_fallback(user_text: str) -> Dict[str, Any]:
+# Every (keyword, row) pair; Hyperscan reports each keyword as its own literal
+LOCAL_KEYWORD_LITERALS: List[Tuple[str, Tuple[str, str, int]]] = [
+    (kw, LOCAL_KEYWORDS_BY_RANK[rank]) for rank, (_, _, kws) in enumerate(LOCAL_KEYWORDS) for kw in kws
+]
+
+# A keyword hit counts as a whole word when it starts on an ASCII word boundary and
+# ends on one after an optional inflection: "statements", "booking" do; "gossip" and
+# "remove my" don't. str and bytes variants, for the re and Hyperscan scans.
+KEYWORD_SUFFIX = r"(?:e?s|e?d|ing|als?)?"
+KEYWORD_WORD_TESTS = {
+    str: (re.compile(r"\w", re.ASCII), re.compile(KEYWORD_SUFFIX + r"\b", re.IGNORECASE | re.ASCII)),
+    bytes: (re.compile(rb"\w"), re.compile((KEYWORD_SUFFIX + r"\b").encode(), re.IGNORECASE)),
+}
+
+
+# ------------------ TEXT SCANNER ------------------
+# Every per-turn classification (PII, advice words, booking code, local-parser
+# keywords) comes out of one scan_text() call. With Hyperscan installed, all the
+# patterns share one compiled database and the text is scanned once; otherwise
+# the precompiled re patterns above are used.
+
+@dataclass(slots=True)
+class TextScan:
+    pii: bool = False
+    advice: bool = False
+    booking_code: Optional[str] = None
+    # field -> (rank, value): highest-precedence keyword per field, substring hits
+    # included (what the quota fallback has always used)
+    keyword_hits: Dict[str, Tuple[int, str]] = field(default_factory=dict)
+    # field -> every distinct value seen as a whole word; all the fast path trusts
+    word_hits: Dict[str, Set[str]] = field(default_factory=dict)
+    # a keyword sat inside some longer word ("gossip") that no whole-word hit
+    # accounts for (the "schedule" in "reschedule" is accounted for)
+    embedded: bool = False
+
+
+def _record_keywords(scan: TextScan, subject, hits: List[Tuple[int, int, Tuple[str, str, int]]]) -> None:
+    """Fold every keyword occurrence (start, end, row) in subject (str or bytes) into scan."""
+    word_char_re, word_end_re = KEYWORD_WORD_TESTS[type(subject)]
+    words: List[Tuple[int, int]] = []
+    embedded: List[Tuple[int, int]] = []
+    for start, end, (field, value, rank) in hits:
+        if field not in scan.keyword_hits or rank < scan.keyword_hits[field][0]:
+            scan.keyword_hits[field] = (rank, value)
+        m = None if start and word_char_re.match(subject, start - 1) else word_end_re.match(subject, end)
+        if m:
+            scan.word_hits.setdefault(field, set()).add(value)
+            words.append((start, m.end()))
+        else:
+            embedded.append((start, end))
+    scan.embedded = any(
+        not any(ws <= start and end <= we for ws, we in words) for start, end in embedded
+    )
+
+
+def keyword_scan(text: str, scan: Optional[TextScan] = None) -> TextScan:
+    scan = scan if scan is not None else TextScan()
+    _record_keywords(scan, text, [
+        (m.start(), m.end(m.lastgroup), LOCAL_KEYWORD_GROUPS[m.lastgroup])
+        for m in LOCAL_KEYWORD_RE.finditer(text)
+    ])
+    return scan
+
+
+# Hyperscan pattern ids; LOCAL_KEYWORD_LITERALS[i] is id HS_KEYWORD_BASE + i
+HS_PII, HS_ADVICE, HS_BOOKING_CODE, HS_KEYWORD_BASE = 0, 1, 2, 3
+BOOKING_CODE_WIDTH = len("NL-") + BOOKING_CODE_LEN
+
+
+def _build_hs_db():
+    guards = [PII_RE.pattern, ADVICE_RE.pattern, BOOKING_CODE_RE.pattern]
+    expressions = guards + [re.escape(kw) for kw, _ in LOCAL_KEYWORD_LITERALS]
+    # No HS_FLAG_UTF8 anywhere: every pattern is ASCII, and byte-wise matching keeps
+    # case folding ASCII-only like the re.ASCII patterns (UTF8|CASELESS lets "ſ" match
+    # [A-Z], which breaks the fixed-width booking code slice below).
+    # SINGLEMATCH: one report per guard pattern is all we need (matches arrive by end
+    # offset, so the fixed-width booking code reported is the leftmost one).
+    # Keywords report every occurrence; their start offset is end - len(keyword).
+    guard_flags = hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH
+    keyword_flags = hyperscan.HS_FLAG_CASELESS
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[e.encode() for e in expressions],
+        ids=list(range(len(expressions))),
+        elements=len(expressions),
+        flags=[guard_flags] * len(guards) + [keyword_flags] * len(LOCAL_KEYWORD_LITERALS),
+    )
+    return db
+
+
+HS_DB = _build_hs_db() if hyperscan else None
+
+
+def _hs_on_match(id_: int, start: int, end: int, flags: int, ctx) -> None:
+    scan, data, hits = ctx
+    if id_ == HS_PII:
+        scan.pii = True
+    elif id_ == HS_ADVICE:
+        scan.advice = True
+    elif id_ == HS_BOOKING_CODE:
+        scan.booking_code = data[end - BOOKING_CODE_WIDTH:end].decode().upper()
+    else:
+        kw, row = LOCAL_KEYWORD_LITERALS[id_ - HS_KEYWORD_BASE]
+        hits.append((end - len(kw), end, row))
+
+
+def scan_text(text: str) -> TextScan:
+    text = fold_digits(text)  # once per turn, for every pattern below
+    if HS_DB is None:
+        return keyword_scan(text, TextScan(
+            pii=contains_pii(text),
+            advice=ADVICE_RE.search(text) is not None,
+            booking_code=extract_booking_code(text),
+        ))
+    scan = TextScan()
+    # text_turn already replaces lone surrogates; don't raise on any that get here
+    data = text.encode("utf-8", errors="replace")
+    hits: List[Tuple[int, int, Tuple[str, str, int]]] = []
+    HS_DB.scan(data, match_event_handler=_hs_on_match, context=(scan, data, hits))
+    _record_keywords(scan, data, hits)
+    return scan
+
+
+def local_intent_fallback(
+    user_text: str,
+    state: SessionState,
+    found: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
     """
-    Offline intent+slot parser used when Gemini quota is exceeded.
+    Offline intent+slot parser. Tried first on every turn (see local_parse_sufficient)
+    and used as the full fallback when Gemini quota is exceeded.
 
     Key behavior:
     - If user provides booking fields (topic/day/time), assume book_new unless they explicitly said cancel/reschedule/etc.
     - Prevents loops like: "Which topic?" -> "KYC" -> intent=other -> menu again.
+    - Pass found (field -> value) from scan_text() to reuse the turn's single scan.
     """
-    t = (user_text or "").lower()
-
-    # topic (best-effort)
-    topic = None
-    if "kyc" in t or "onboard" in t:
-        topic = "KYC/Onboarding"
-    elif "sip" in t or "mandate" in t:
-        topic = "SIP/Mandates"
-    elif "statement" in t or "tax" in t:
-        topic = "Statements/Tax Docs"
-    elif "withdraw" in t or "timeline" in t or "redemption" in t:
-        topic = "Withdrawals & Timelines"
-    elif "nominee" in t or "account change" in t or "profile" in t:
-        topic = "Account Changes/Nominee"
-
-    # day preference
-    day_preference = None
-    if "tomorrow" in t:
-        day_preference = "tomorrow"
-    elif "today" in t:
-        day_preference = "today"
-    else:
-        for d in ["monday","tuesday","wednesday","thursday","friday","saturday","sunday"]:
-            if d in t:
-                day_preference = d
-                break
+    if found is None:
+        found = {field: value for field, (_, value) in keyword_scan(user_text or "").keyword_hits.items()}
 
-    # time preference
-    time_preference = None
-    if "morning" in t:
-        time_preference = "morning"
-    elif "afternoon" in t:
-        time_preference = "afternoon"
-    elif "evening" in t or "night" in t:
-        time_preference = "evening"
-
-    # explicit intent commands
-    if any(w in t for w in ["reschedule", "move my", "change my time", "change slot"]):
-        intent = "reschedule"
-    elif any(w in t for w in ["cancel", "call off", "delete booking"]):
-        intent = "cancel"
-    elif any(w in t for w in ["prepare", "what should i bring", "what to prepare"]):
-        intent = "what_to_prepare"
-    elif any(w in t for w in ["availability", "available", "check availability", "any slots"]):
-        intent = "check_availability"
-    elif any(w in t for w in ["book", "appointment", "schedule"]):
-        intent = "book_new"
-    else:
-        intent = "other"
+    topic = found.get("topic")
+    day_preference = found.get("day_preference")
+    time_preference = found.get("time_preference")
+    intent = found.get("intent", "other")
 
     # ✅ NEW RULE: if user provides booking fields, default to booking
     # (unless they explicitly asked cancel/reschedule/prepare)
@@ -259,7 +721,7 @@ def local_intent_fallback(user_text: str) -> Dict[str, Any]:
         intent = "book_new"
 
     # ✅ Existing rule: if mid-booking and they provide fields, keep booking
-    mid_booking = bool(STATE.get("topic") or STATE.get("day_pref") or STATE.get("time_pref"))
+    mid_booking = bool(state.topic or state.day_pref or state.time_pref)
     if intent == "other" and mid_booking and gave_booking_fields:
         intent = "book_new"
 
@@ -271,20 +733,39 @@ def local_intent_fallback(user_text: str) -> Dict[str, Any]:
     }
 
 
-def detect_intent_and_extract(user_text: str) -> Dict[str, Any]:
+INTENT_KEYS = ("intent", "topic", "day_preference", "time_preference")
+
+# Gemini structured output: the reply is guaranteed to be exactly this object
+INTENT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "intent": {"type": "STRING", "enum": INTENTS},
+        "topic": {"type": "STRING", "enum": TOPICS, "nullable": True},
+        "day_preference": {"type": "STRING", "nullable": True},
+        "time_preference": {"type": "STRING", "nullable": True},
+    },
+    "required": list(INTENT_KEYS),
+}
+INTENT_CACHE_SIZE = 2048
+_INTENT_CACHE: "OrderedDict[str, Tuple[Any, ...]]" = OrderedDict()
+
+
+async def _detect_cached(norm_text: str) -> Tuple[Any, ...]:
     """
-    Returns dict; never throws.
-    - Handles ```json fenced outputs
-    - Falls back to local parser if Gemini quota is hit (429)
+    Gemini intent parse keyed on normalized text, so repeated short phrases
+    ("kyc", "tomorrow morning") skip the round-trip. LRU-bounded; API errors
+    propagate and are therefore never cached.
     """
-    if not user_text or not user_text.strip():
-        return _json_fallback()
+    hit = _INTENT_CACHE.get(norm_text)
+    if hit is not None:
+        _INTENT_CACHE.move_to_end(norm_text)
+        return hit
 
     prompt = f"""
 Return STRICT JSON only (no markdown, no code fences).
 
 Allowed intents:
-book_new, reschedule, cancel, what_to_prepare, check_availability, other
+{", ".join(INTENTS)}
 
 Allowed topics (must match exactly if present):
 {", ".join(TOPICS)}
@@ -293,25 +774,53 @@ Keys (always include):
 intent, topic, day_preference, time_preference
 
 User said:
-{user_text}
+{norm_text}
 """.strip()
 
-    try:
-        resp = gemini.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=prompt,
-        )
-        raw = (resp.text or "").strip()
-        print("INTENT RAW:", repr(raw))
+    resp = await gemini.aio.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=prompt,
+        config={"response_mime_type": "application/json", "response_schema": INTENT_SCHEMA},
+    )
+    raw = (resp.text or "").strip()
+    logger.debug("INTENT RAW: %r", raw)
 
+    try:
+        obj = json_loads(raw)
+    except ValueError:
+        # Shouldn't happen with a response schema; salvage what we can
         obj = extract_first_json_object(raw)
-        return obj if obj else _json_fallback()
+    if not isinstance(obj, dict):
+        obj = _json_fallback()
+    result = _INTENT_CACHE[norm_text] = tuple(obj.get(k) for k in INTENT_KEYS)
+    if len(_INTENT_CACHE) > INTENT_CACHE_SIZE:
+        _INTENT_CACHE.popitem(last=False)
+    return result
+
+
+async def detect_intent_and_extract(
+    user_text: str,
+    state: SessionState,
+    local: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Returns dict; never throws.
+    - Handles ```json fenced outputs
+    - Caches Gemini results per normalized text (see _detect_cached)
+    - Falls back to local parser if Gemini quota is hit (429); pass `local` to reuse a parse already done
+    """
+    if not user_text or not user_text.strip():
+        return _json_fallback()
+
+    norm = " ".join(user_text.lower().split())
+    try:
+        return dict(zip(INTENT_KEYS, await _detect_cached(norm)))
 
     except Exception as e:
         # If we hit quota or any API issue, keep demo working
-        print("INTENT_FALLBACK_REASON:", repr(e))
-        fb = local_intent_fallback(user_text)
-        print("INTENT LOCAL FALLBACK:", fb)
+        logger.warning("INTENT_FALLBACK_REASON: %r", e)
+        fb = local if local is not None else local_intent_fallback(user_text, state)
+        logger.debug("INTENT LOCAL FALLBACK: %s", fb)
         return fb
 
 
@@ -328,9 +837,9 @@ def mock_pick_two_slots(day_pref: str, time_pref: str) -> List[Dict[str, str]]:
     return candidates[:2]
 
 
-def waitlist_flow_reply(topic: str, day_pref: str, time_pref: str) -> str:
-    code = STATE.get("booking_code") or generate_booking_code()
-    STATE["booking_code"] = code
+def waitlist_flow_reply(state: SessionState, topic: str, day_pref: str, time_pref: str) -> str:
+    code = state.booking_code or generate_booking_code()
+    state.booking_code = code
     link = secure_link_for(code)
 
     return (
@@ -364,16 +873,63 @@ PREP_GUIDES = {
     ],
 }
 
+# Rendered once at import: "1. tip 2. tip"
+PREP_TEXT: Dict[str, str] = {
+    topic: " ".join(f"{i+1}. {t}" for i, t in enumerate(tips))
+    for topic, tips in PREP_GUIDES.items()
+}
+
 
 # ------------------ AGENT LOGIC ------------------
 
-def next_agent_reply(user_text: str) -> str:
+def local_parse_sufficient(state: SessionState, scan: TextScan) -> bool:
+    """
+    True when whole-word keyword hits already settle every field the state machine
+    will read this turn, so the Gemini round-trip can be skipped.
+    Anything the keywords can't settle goes to Gemini: two values for one field
+    ("evening, not morning"), competing intents, a keyword buried in another word
+    ("remove my appointment"), or an availability ask.
+    Judged before local_intent_fallback's book_new promotion, which is only
+    meant for the quota fallback.
+    """
+    if scan.embedded or any(len(values) > 1 for values in scan.word_hits.values()):
+        return False
+    hits = {field: value for field, (value,) in scan.word_hits.items()}
+    intent = hits.get("intent")
+
+    # A booking is in progress once it has a topic, or once book_new was asked for
+    # and the user is answering "which topic?"
+    if state.offered_slots or state.topic or (state.intent == "book_new" and intent in (None, "book_new")):
+        # only the next missing field is read (none once slots are offered)
+        for have, key in (
+            (state.topic, "topic"),
+            (state.day_pref, "day_preference"),
+            (state.time_pref, "time_preference"),
+        ):
+            if not have:
+                return key in hits
+        return True
+
+    if intent in ("cancel", "reschedule", "book_new"):
+        # missing booking code / booking fields are simply asked for next
+        return True
+    if intent == "what_to_prepare":
+        return hits.get("topic") in TOPICS
+    if intent is None:
+        # with no intent word, a full topic+day+time still means booking
+        return all(key in hits for key in ("topic", "day_preference", "time_preference"))
+    return False  # check_availability: listed without booking, so read the whole ask
+
+
+async def next_agent_reply(state: SessionState, user_text: str) -> str:
     user_text = (user_text or "").strip()
     if not user_text:
         return "Sorry, I didn’t catch that. Please repeat."
 
-    if contains_pii(user_text):
-        code = STATE.get("booking_code") or "NL-XXXX"
+    scan = scan_text(user_text)
+
+    if scan.pii:
+        code = state.booking_code or "NL-XXXX"
         link = secure_link_for(code)
         return (
             "For security, please don’t share personal details on this call. "
@@ -381,8 +937,8 @@ def next_agent_reply(user_text: str) -> str:
             "Now, what topic is this about?"
         )
 
-    if not STATE["disclaimer_done"]:
-        STATE["disclaimer_done"] = True
+    if not state.disclaimer_done:
+        state.disclaimer_done = True
         return (
             "Hi — this is the Advisor Appointment Scheduler. "
             "This call is for informational support only and not investment advice. "
@@ -390,43 +946,53 @@ def next_agent_reply(user_text: str) -> str:
         )
 
     lower = user_text.lower()
-    if any(k in lower for k in ["buy", "sell", "invest", "stock", "mutual fund", "recommend"]):
+    if scan.advice:
         return (
             "I can’t provide investment advice or recommendations. "
             "I can help with account processes or book an informational advisor session. "
             "Which topic is this for: KYC/Onboarding, SIP/Mandates, Statements/Tax Docs, Withdrawals & Timelines, or Account Changes/Nominee?"
         )
 
-    info = detect_intent_and_extract(user_text)
+    # Rule-based parse first; Gemini only when it can't resolve what this turn needs
+    if local_parse_sufficient(state, scan):
+        # every field has at most one whole-word value here
+        found = {field: value for field, (value,) in scan.word_hits.items()}
+        info = local_intent_fallback(user_text, state, found)
+        logger.debug("INTENT LOCAL: %s", info)
+    else:
+        found = {field: value for field, (_, value) in scan.keyword_hits.items()}
+        info = await detect_intent_and_extract(
+            user_text, state, local=local_intent_fallback(user_text, state, found)
+        )
     intent = (info.get("intent") or "other").strip()
 
     # ✅ If booking has started, NEVER leave booking flow
-    if STATE.get("offered_slots") or STATE.get("topic"):
+    if state.offered_slots or state.topic:
         intent = "book_new"
 
-    STATE["intent"] = intent
+    state.intent = intent
 
 
     # Cancel
     if intent == "cancel":
-        if not STATE["provided_code"]:
-            code = extract_booking_code(user_text)
+        if not state.provided_code:
+            code = scan.booking_code
             if code:
-                STATE["provided_code"] = code
+                state.provided_code = code
             else:
                 return "Sure. Please tell me your booking code, for example NL-A742."
-        code = STATE["provided_code"]
-        reset_booking_state()
-        reset_reschedule_cancel()
+        code = state.provided_code
+        reset_booking_state(state)
+        reset_reschedule_cancel(state)
         return f"Done. I’ve noted a cancellation request for booking code {code}."
 
     # Reschedule
     if intent == "reschedule":
-        if not STATE["provided_code"]:
-            code = extract_booking_code(user_text)
+        if not state.provided_code:
+            code = scan.booking_code
             if code:
-                STATE["provided_code"] = code
-                reset_booking_state()
+                state.provided_code = code
+                reset_booking_state(state)
                 return (
                     f"Got it. Booking code {code}. "
                     f"What topic is this for, and what day and time preference in {TIMEZONE_LABEL}?"
@@ -434,15 +1000,13 @@ def next_agent_reply(user_text: str) -> str:
             else:
                 return "Sure. Please tell me your booking code, for example NL-A742."
         intent = "book_new"
-        STATE["intent"] = "book_new"
+        state.intent = "book_new"
 
     # What to prepare
     if intent == "what_to_prepare":
         topic = info.get("topic")
         if topic in TOPICS:
-            tips = PREP_GUIDES.get(topic, [])
-            tip_text = " ".join([f"{i+1}. {t}" for i, t in enumerate(tips)]) if tips else ""
-            return f"For {topic}, here’s what to prepare: {tip_text}"
+            return f"For {topic}, here’s what to prepare: {PREP_TEXT.get(topic, '')}"
         return "Sure — which topic: KYC/Onboarding, SIP/Mandates, Statements/Tax Docs, Withdrawals & Timelines, or Account Changes/Nominee?"
 
     # Check availability
@@ -469,38 +1033,38 @@ def next_agent_reply(user_text: str) -> str:
     if intent != "book_new":
         if "book" in lower or "appointment" in lower or "slot" in lower:
             intent = "book_new"
-            STATE["intent"] = "book_new"
+            state.intent = "book_new"
         else:
             return "I can help you book, reschedule, cancel, check availability, or tell you what to prepare. What would you like to do?"
 
     # ---- BOOK NEW FLOW ----
-    if not STATE["topic"]:
+    if not state.topic:
         topic = info.get("topic")
         if topic in TOPICS:
-            STATE["topic"] = topic
+            state.topic = topic
         else:
             return "Which topic is this for: KYC/Onboarding, SIP/Mandates, Statements/Tax Docs, Withdrawals & Timelines, or Account Changes/Nominee?"
 
-    if not STATE["day_pref"]:
+    if not state.day_pref:
         day_pref = info.get("day_preference")
         if day_pref:
-            STATE["day_pref"] = day_pref
+            state.day_pref = day_pref
         else:
             return "What day works best for you? For example tomorrow, Friday, or next week."
 
-    if not STATE["time_pref"]:
+    if not state.time_pref:
         time_pref = info.get("time_preference")
         if time_pref:
-            STATE["time_pref"] = time_pref
+            state.time_pref = time_pref
         else:
             return f"Do you prefer morning, afternoon, or evening {TIMEZONE_LABEL}?"
 
-    if not STATE["offered_slots"]:
-        slots = mock_pick_two_slots(STATE["day_pref"], STATE["time_pref"])
+    if not state.offered_slots:
+        slots = mock_pick_two_slots(state.day_pref, state.time_pref)
         if not slots or len(slots) < 2:
-            return waitlist_flow_reply(STATE["topic"], STATE["day_pref"], STATE["time_pref"])
+            return waitlist_flow_reply(state, state.topic, state.day_pref, state.time_pref)
 
-        STATE["offered_slots"] = slots
+        state.offered_slots = slots
         return (
             f"I have two options in {TIMEZONE_LABEL}. "
             f"Option 1: {slots[0]['start']} {TIMEZONE_LABEL}. "
@@ -508,74 +1072,152 @@ def next_agent_reply(user_text: str) -> str:
             "Which option do you prefer, 1 or 2?"
         )
 
-    if not STATE["selected_slot"]:
+    if not state.selected_slot:
         if "1" in lower or "one" in lower:
-            STATE["selected_slot"] = STATE["offered_slots"][0]
+            state.selected_slot = state.offered_slots[0]
         elif "2" in lower or "two" in lower:
-            STATE["selected_slot"] = STATE["offered_slots"][1]
+            state.selected_slot = state.offered_slots[1]
         else:
             return "Please say option 1 or option 2."
 
-        slot = STATE["selected_slot"]
+        slot = state.selected_slot
         return (
             f"Just to confirm in {TIMEZONE_LABEL}: "
-            f"{STATE['topic']} on {slot['start']} {TIMEZONE_LABEL}. "
+            f"{state.topic} on {slot['start']} {TIMEZONE_LABEL}. "
             "Is that correct? Say yes or no."
         )
 
-    if not STATE["booking_code"]:
+    if not state.booking_code:
         if "yes" in lower:
             code = generate_booking_code()
-            STATE["booking_code"] = code
-            slot = STATE["selected_slot"]
+            state.booking_code = code
+            slot = state.selected_slot
             link = secure_link_for(code)
 
-            BOOKINGS[code] = {
-                "topic": STATE["topic"],
+            booking = {
+                "topic": state.topic,
                 "slot": slot,
                 "timezone": TIMEZONE_LABEL,
             }
-            print("BOOKING CREATED:", BOOKINGS[code])
+            await BOOKINGS.set(code, booking)
+            logger.info("BOOKING CREATED: %s", booking)
 
 
             return (
                 f"Great. Your booking code is {code}. "
-                f"Your tentative slot is {slot['start']} {TIMEZONE_LABEL} for {STATE['topic']}. "
+                f"Your tentative slot is {slot['start']} {TIMEZONE_LABEL} for {state.topic}. "
                 "For security, I can’t collect personal details on this call. "
                 f"Please use this secure link to finish details: {link}."
             )
         else:
-            STATE["selected_slot"] = None
+            state.selected_slot = None
             return "No problem. Do you prefer option 1 or option 2?"
 
     return "All set. Do you need anything else?"
 
 
+# ------------------ MCP PAYLOADS ------------------
+# Constant parts live in defaults/templates; only per-booking values are filled in.
+# kw_only keeps field (and so JSON key) order while allowing defaults up front.
+
+EMAIL_BODY_TMPL = string.Template(
+    "Hi Advisor Team,\n\n"
+    "A caller has tentatively booked an advisor slot.\n\n"
+    "Booking Code: $code\n"
+    "Topic: $topic\n"
+    "Slot (IST): $slot\n"
+    "Caller Email: $email\n"
+    "Caller Phone: $phone\n"
+    "Notes: $notes\n\n"
+    "Please review and confirm.\n"
+)
+
+
+@dataclass(slots=True, kw_only=True)
+class McpCalendarHold:
+    action: str = "calendar.create_hold"
+    title: str
+    start: Optional[str]
+    timezone: str = TIMEZONE_LABEL
+    status: str = "tentative"
+
+
+@dataclass(slots=True, kw_only=True)
+class McpNotesAppend:
+    action: str = "notes.append"
+    doc: str = "Advisor Pre-Bookings"
+    entry: Dict[str, Any]
+
+
+@dataclass(slots=True, kw_only=True)
+class McpEmailDraft:
+    action: str = "email.create_draft"
+    approval_required: bool = True
+    to: str = "advisor-team@example.com"
+    subject: str
+    body: str
+
+
 # ------------------ API ------------------
 
+def save_upload(audio_bytes: bytes, suffix: str) -> str:
+    """Debug only: keep a copy of the upload. Server-chosen name; never trust audio.filename as a path."""
+    with tempfile.NamedTemporaryFile(delete=False, dir=TMP_DIR, suffix=suffix) as f:
+        f.write(audio_bytes)
+        return f.name
+
+
 @app.post("/api/voice-turn")
-async def voice_turn(audio: UploadFile = File(...)):
+async def voice_turn(
+    response: Response,
+    audio: UploadFile = File(...),
+    x_session_id: Optional[str] = Header(None),
+):
+    # Body size is already bounded by UploadLimitMiddleware before the form is parsed
+    if not (audio.content_type or "audio/webm").startswith("audio/"):
+        raise HTTPException(status_code=415, detail=f"unsupported audio type: {audio.content_type}")
+
     try:
-        os.makedirs("tmp", exist_ok=True)
-        in_path = os.path.join("tmp", audio.filename)
+        buf = bytearray()
+        while chunk := await audio.read(UPLOAD_CHUNK_SIZE):
+            buf += chunk
+            if len(buf) > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="audio too large")
+        audio_bytes = bytes(buf)
+
+        if SAVE_UPLOADS:
+            suffix = os.path.splitext(audio.filename or "")[1]
+            await asyncio.to_thread(save_upload, audio_bytes, suffix)
 
-        with open(in_path, "wb") as f:
-            f.write(await audio.read())
+        transcript = await transcribe_batched(audio_bytes, audio.content_type or "audio/webm")
 
-        transcript = transcribe(in_path)
-        reply_text = next_agent_reply(transcript)
+        session_id, state = get_session(x_session_id)
+        response.headers["X-Session-Id"] = session_id
+        async with state.lock:
+            reply_text = await next_agent_reply(state, transcript)
 
         return {"transcript": transcript, "reply_text": reply_text}
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print("VOICE_TURN_ERROR:", repr(e))
-        print(traceback.format_exc())
+        logger.exception("VOICE_TURN_ERROR: %r", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/text-turn")
-async def text_turn(payload: Dict[str, Any] = Body(...)):
-    user_text = (payload.get("text") or "").strip()
-    reply_text = next_agent_reply(user_text)
+async def text_turn(
+    response: Response,
+    payload: Dict[str, Any] = Body(...),
+    x_session_id: Optional[str] = Header(None),
+):
+    # JSON "\ud800" decodes to a lone surrogate, which can't be UTF-8 encoded for the
+    # scanner or the echoed response; replace it here rather than 500 later
+    user_text = (payload.get("text") or "").encode("utf-8", errors="replace").decode().strip()
+
+    session_id, state = get_session(x_session_id)
+    response.headers["X-Session-Id"] = session_id
+    async with state.lock:
+        reply_text = await next_agent_reply(state, user_text)
     return {
         "transcript": user_text,
         "reply_text": reply_text,
@@ -592,13 +1234,13 @@ async def secure_details(payload: Dict[str, Any] = Body(...)):
         return {"error": "booking_code and email are required"}
 
     # Store securely (demo: in-memory)
-    SECURE_DETAILS_STORE[booking_code] = {
+    await SECURE_DETAILS_STORE.set(booking_code, {
         "email": email,
         "phone": phone,
         "notes": notes,
-    }
+    })
 
-    # Use current STATE if it matches this booking code (demo assumption)
+    # Look up the booking created during the call
     booking = BOOKINGS.get(booking_code)
     if not booking:
         return {"error": f"Unknown booking_code: {booking_code}. Please use the code provided by the agent."}
@@ -608,47 +1250,36 @@ async def secure_details(payload: Dict[str, Any] = Body(...)):
     timezone = booking.get("timezone")
 
     # MCP-ready payloads (these are what n8n/MCP would consume)
-    mcp_calendar_hold = {
-        "action": "calendar.create_hold",
-        "title": f"Advisor Q&A — {topic} — {booking_code}",
-        "start": slot.get("start"),
-        "timezone": TIMEZONE_LABEL,
-        "status": "tentative",
-    }
+    mcp_calendar_hold = McpCalendarHold(
+        title=f"Advisor Q&A — {topic} — {booking_code}",
+        start=slot.get("start"),
+    )
 
-    mcp_notes_append = {
-        "action": "notes.append",
-        "doc": "Advisor Pre-Bookings",
-        "entry": {
+    mcp_notes_append = McpNotesAppend(
+        entry={
             "date": slot.get("start"),
             "topic": topic,
             "slot_id": slot.get("slot_id"),
             "code": booking_code,
             "contact_email": email,
         },
-    }
+    )
 
-    mcp_email_draft = {
-        "action": "email.create_draft",
-        "approval_required": True,
-        "to": "advisor-team@example.com",
-        "subject": f"Pre-booking request — {topic} — {booking_code}",
-        "body": (
-            f"Hi Advisor Team,\n\n"
-            f"A caller has tentatively booked an advisor slot.\n\n"
-            f"Booking Code: {booking_code}\n"
-            f"Topic: {topic}\n"
-            f"Slot (IST): {slot.get('start')}\n"
-            f"Caller Email: {email}\n"
-            f"Caller Phone: {phone or 'Not provided'}\n"
-            f"Notes: {notes or '—'}\n\n"
-            f"Please review and confirm.\n"
+    mcp_email_draft = McpEmailDraft(
+        subject=f"Pre-booking request — {topic} — {booking_code}",
+        body=EMAIL_BODY_TMPL.substitute(
+            code=booking_code,
+            topic=topic,
+            slot=slot.get("start"),
+            email=email,
+            phone=phone or "Not provided",
+            notes=notes or "—",
         ),
-    }
+    )
 
-    print("MCP_CALENDAR_HOLD:", mcp_calendar_hold)
-    print("MCP_NOTES_APPEND:", mcp_notes_append)
-    print("MCP_EMAIL_DRAFT:", mcp_email_draft)
+    logger.info("MCP_CALENDAR_HOLD: %s", mcp_calendar_hold)
+    logger.info("MCP_NOTES_APPEND: %s", mcp_notes_append)
+    logger.info("MCP_EMAIL_DRAFT: %s", mcp_email_draft)
 
     return {
         "ok": True,
@@ -0,0 +1,62 @@
+"""
+scan_text() has two backends: one Hyperscan database, or the precompiled re
+patterns. Whichever is installed, a turn must classify the same way.
+
+Run from backend/:  python -m pytest test_text_scan.py
+"""
+import os
+import random
+
+import pytest
+
+os.environ.setdefault("GEMINI_API_KEY", "test")  # main builds its client at import
+
+import main  # noqa: E402
+
+pytestmark = pytest.mark.skipif(main.HS_DB is None, reason="hyperscan not installed")
+
+# Keywords plus inputs that have split the backends before: non-ASCII case folding
+# ("ſ", Kelvin "K"), keywords inside other words, other scripts' digits, surrogates.
+WORDS = [kw for kw, _ in main.LOCAL_KEYWORD_LITERALS] + [
+    "a@b.com", "98765 43210", "9876543210", "account no 12", "call 1-800-555-0100",
+    "nl-ab12", "NL-ZZ99", "xnl-ab12", "nl-ſipK", "ſell", "KYC",
+    "buy", "invest", "fortnight", "gossip", "remove my", "sipping", "taxes", "onboarding",
+    "९८७६५४३२१०", "１２３４５６７８９０", "nl-ab١٢", "kyc٣", "²", "①",
+    "é", "ünïcode", "\ud800", "12", "-", ".", "  ",
+]
+
+
+def scan_both(text):
+    hs_db = main.HS_DB
+    try:
+        with_hs = main.scan_text(text)
+        main.HS_DB = None
+        with_re = main.scan_text(text)
+    finally:
+        main.HS_DB = hs_db
+    return with_hs, with_re
+
+
+def test_backends_agree_on_random_turns():
+    rng = random.Random(3)
+    for _ in range(30000):
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 6)))
+        if rng.random() < 0.2:
+            text = text.replace(" ", "")
+        if rng.random() < 0.2:
+            text = text.upper()
+        with_hs, with_re = scan_both(text)
+        assert with_hs == with_re, repr(text)
+
+
+@pytest.mark.parametrize("text, pii, booking_code", [
+    ("cancel nl-ſipK", False, None),
+    ("cancel nl-ab12", False, "NL-AB12"),
+    ("my number is ९८७६५४३२१०", True, None),
+    ("１２３４５６７８９０", True, None),
+    ("x² and ①②③④⑤⑥⑦⑧⑨①", False, None),
+    ("\ud800 hi", False, None),
+])
+def test_guards(text, pii, booking_code):
+    for scan in scan_both(text):
+        assert (scan.pii, scan.booking_code) == (pii, booking_code)
@@ -3,6 +3,8 @@ import { useRef, useState } from "react";
 export default function App() {
   const mediaRecorderRef = useRef(null);
   const chunksRef = useRef([]);
+  // One conversation per page load; backend keys booking state by this id
+  const sessionIdRef = useRef(crypto.randomUUID());
 
   const [isRecording, setIsRecording] = useState(false);
   const [status, setStatus] = useState("Idle");
@@ -45,6 +47,7 @@ export default function App() {
 
           const res = await fetch("http://localhost:8000/api/voice-turn", {
             method: "POST",
+            headers: { "X-Session-Id": sessionIdRef.current },
             body: form,
           });
 
@@ -86,7 +89,10 @@ export default function App() {
     try {
       const res = await fetch("http://localhost:8000/api/text-turn", {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
+        headers: {
+          "Content-Type": "application/json",
+          "X-Session-Id": sessionIdRef.current,
+        },
         body: JSON.stringify({ text: typedText }),
       });
 